@@ -1,71 +1,348 @@
-import pandas as pd
+import csv
+import numpy as np
 import streamlit as st
 import folium
+from folium.plugins import MarkerCluster
 import requests
+import httpx
+import asyncio
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import polyline
+try:
+    # Compiled decoder, much faster than polyline on long geometries
+    from pypolyline.cutil import decode_polyline as _decode_polyline
+except ImportError:
+    _decode_polyline = None
+try:
+    # JIT compiles the fallback decoder when pypolyline is not installed
+    from numba import njit
+except ImportError:
+    njit = None
 from pathlib import Path
+from diskcache import Cache
+import hashlib
 import random
+from itertools import starmap
+from streamlit_folium import st_folium
 
 OSRM_URL = "http://router.project-osrm.org/route/v1/driving/"
+ROUTES_PATH = Path(__file__).parent / "routes"
+PRECOMPUTED_PATH = ROUTES_PATH / "_cache" # Written by tools/precompute_routes.py
 SC_COORDS = (14.713214, -17.463984)
+# OSRM geometry format: "geojson" skips client side decoding, "polyline" is smaller on the wire for slow networks
+OSRM_GEOMETRIES = "geojson"
+OSRM_TIMEOUT = (3, 10) # Connect and read timeouts in seconds, a stalled OSRM call must not hang the app
+MAX_URL_LENGTH = 4096 # Above this, batched requests fall back to one call per route
+SIMPLIFY_EPSILON = 1e-5 # Tolerance in degrees (about 1m) when simplifying routes before drawing them
+# Routes are (N, 2) arrays of (latitude, longitude), float32 is precise to about 20cm here
+ROUTE_DTYPE = np.float32
 
+# On disk cache of the decoded OSRM routes, it survives server restarts unlike st.cache_data
+_CACHE = Cache(Path(__file__).parent / ".osrm_cache")
 
-@st.cache_data # Cache the route data to avoid repeated API calls
-def get_osrm_route(stops: pd.DataFrame) -> list[tuple[float, float]] | None:
+# Shared session so connections to OSRM are kept alive and reused across routes
+# Failed connections and gateway errors of the public server are retried twice with backoff
+_RETRY = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=_RETRY))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=_RETRY))
+
+
+def format_coordinates(stops: list[tuple[float, float, str]]) -> str:
+    """
+    Formats stops as the "lon,lat;lon,lat" coordinate list expected by OSRM.
+    """
+    # starmap calls the bound format method without a Python level loop body, the name is ignored
+    return ';'.join(starmap("{1},{0}".format, stops))
+
+
+def cache_key(url: str) -> str:
+    """
+    Key of an OSRM response in the disk cache, it changes with the route dtype.
+    """
+    return hashlib.sha1(f"{url}|{np.dtype(ROUTE_DTYPE)}".encode()).hexdigest()
+
+
+def route_url(stops: list[tuple[float, float, str]]) -> str:
+    return (
+        f"{OSRM_URL}{format_coordinates(stops)}?overview=full&geometries={OSRM_GEOMETRIES}"
+        "&continue_straight=false"
+    )
+
+
+def decode_route_response(data: dict, key: str) -> np.ndarray | None:
+    """
+    Decodes the route of an OSRM response and stores it in the disk cache under key.
+    Raises ValueError with the OSRM message when OSRM did not find a route.
+    """
+    if data and data.get('code') == 'Ok' and data.get('routes'):
+        # Convert the geometry into (latitude, longitude) pairs
+        decoded_route = parse_geometry(data['routes'][0]['geometry']).astype(ROUTE_DTYPE)
+        _CACHE.set(key, decoded_route)
+        return decoded_route
+    raise ValueError(f"OSRM Error: {data.get('message', 'No route found or unexpected response.')}")
+
+
+def get_osrm_route(stops: list[tuple[float, float, str]]) -> np.ndarray:
+    """
+    Fetches a driving route from the OSRM API, used outside of the app by tools/precompute_routes.py.
+    Returns an (N, 2) array of (latitude, longitude) representing the route.
+    Raises requests.exceptions.RequestException when OSRM can not be reached
+    and ValueError when it does not find a route.
+    """
+    url = route_url(stops)
+    key = cache_key(url)
+    if key in _CACHE:
+        return _CACHE[key]
+    # OSRM explains why it found no route in the JSON body of its 400 responses
+    return decode_route_response(_SESSION.get(url, timeout=OSRM_TIMEOUT).json(), key)
+
+
+async def fetch_osrm_route(client: httpx.AsyncClient, stops: list[tuple[float, float, str]]) -> np.ndarray | None:
     """
-    Fetches a driving route from the OSRM API.
-    Returns a list of (latitude, longitude) tuples representing the route.
+    Asynchronous version of get_osrm_route, sharing the connections of client.
+    Errors are reported in the app and the route is then None.
     """
-    coordinates = ';'.join([f"{lon},{lat}" for lat, lon in stops[["Latitude", "Longitude"]].values])
-    url = f"{OSRM_URL}{coordinates}?overview=full&geometries=polyline"
+    url = route_url(stops)
+    key = cache_key(url)
+    if key in _CACHE:
+        return _CACHE[key]
 
     try:
-        response = requests.get(url)
-        response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        data = response.json()
-
-        if data and data['code'] == 'Ok' and data['routes']:
-            encoded_polyline = data['routes'][0]['geometry']
-            # Decode the polyline string into a list of (latitude, longitude) pairs
-            decoded_route = polyline.decode(encoded_polyline)
-            return decoded_route
-        else:
-            st.error(f"OSRM Error: {data.get('message', 'No route found or unexpected response.')}")
-            return None
-    except requests.exceptions.RequestException as e:
+        response = await client.get(url)
+        response.raise_for_status()
+        return decode_route_response(response.json(), key)
+    except httpx.HTTPError as e:
         st.error(f"Error connecting to OSRM: {e}")
         return None
+    except ValueError as e:
+        st.error(str(e))
+        return None
     except Exception as e:
         st.error(f"An unexpected error occurred: {e}")
         return None
-    
+
+
+async def fetch_osrm_routes(routes_stops: list[list[tuple[float, float, str]]]) -> list[np.ndarray | None]:
+    """
+    Fetches the driving routes concurrently from a single event loop.
+    """
+    # The client ignores its own limits when given a transport, they are set on the transport
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(OSRM_TIMEOUT[1], connect=OSRM_TIMEOUT[0]),
+        transport=httpx.AsyncHTTPTransport(
+            retries=2, # Only retries failed connections
+            limits=httpx.Limits(max_connections=32),
+        ),
+    ) as client:
+        return await asyncio.gather(*(fetch_osrm_route(client, stops) for stops in routes_stops))
+
+
+def _decode_polyline_buffer(buffer: np.ndarray, precision: int) -> np.ndarray:
+    """
+    Decodes the bytes of an encoded polyline into an (N, 2) array of (latitude, longitude).
+    Written with plain loops so that numba can compile it when installed.
+    Raises ValueError when the polyline is truncated.
+    """
+    # Every coordinate takes at least one byte
+    points = np.empty((len(buffer) // 2, 2), np.int64)
+    count = 0
+    index = 0
+    lat = 0
+    lon = 0
+    while index < len(buffer):
+        for axis in range(2):
+            result = 0
+            shift = 0
+            while True:
+                # Compiled code does not check bounds, a truncated polyline must not read past the end
+                if index >= len(buffer):
+                    raise ValueError("Truncated polyline")
+                chunk = np.int64(buffer[index]) - 63
+                index += 1
+                result |= (chunk & 0x1f) << shift
+                shift += 5
+                if chunk < 0x20:
+                    break
+            delta = ~(result >> 1) if result & 1 else result >> 1
+            if axis == 0:
+                lat += delta
+            else:
+                lon += delta
+        points[count, 0] = lat
+        points[count, 1] = lon
+        count += 1
+    return points[:count] / 10.0 ** precision
+
+
+if njit is not None:
+    _decode_polyline_buffer = njit(cache=True)(_decode_polyline_buffer)
+
+
+def decode_polyline(encoded_polyline: str) -> np.ndarray:
+    """
+    Decodes an OSRM polyline (precision 5) into an (N, 2) array of (latitude, longitude).
+    """
+    if _decode_polyline is not None:
+        # pypolyline returns (longitude, latitude) pairs
+        return np.asarray(_decode_polyline(encoded_polyline.encode("utf-8"), 5)).reshape(-1, 2)[:, ::-1]
+    if njit is not None:
+        return _decode_polyline_buffer(np.frombuffer(encoded_polyline.encode("ascii"), np.uint8), 5)
+    return np.asarray(polyline.decode(encoded_polyline)).reshape(-1, 2)
+
+
+def parse_geometry(geometry: str | dict) -> np.ndarray:
+    """
+    Converts an OSRM geometry, either an encoded polyline or a GeoJSON LineString,
+    into an (N, 2) array of (latitude, longitude).
+    """
+    if isinstance(geometry, str):
+        return decode_polyline(geometry)
+    # GeoJSON coordinates are (longitude, latitude) pairs
+    return np.asarray(geometry['coordinates'], dtype=float).reshape(-1, 2)[:, ::-1]
+
+
+def simplify_route(points: np.ndarray, epsilon: float = SIMPLIFY_EPSILON) -> np.ndarray:
+    """
+    Simplifies a route with the Ramer-Douglas-Peucker algorithm.
+    Points closer than epsilon to the simplified line are dropped, which keeps the
+    drawn itinerary visually identical while shrinking the HTML folium generates.
+    Returns the kept points as an (N, 2) array of (latitude, longitude).
+    """
+    coords = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(coords) < 3:
+        return coords.astype(ROUTE_DTYPE)
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = coords[end] - coords[start]
+        offsets = coords[start + 1:end] - coords[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            # Distance of each point to the line through the segment ends
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > epsilon:
+            farthest += start + 1
+            keep[farthest] = True
+            stack += [(start, farthest), (farthest, end)]
+    return coords[keep].astype(ROUTE_DTYPE)
+
+
+def decode_leg(leg: dict) -> np.ndarray:
+    """
+    Decodes the geometry of an OSRM route leg by chaining the geometries of its steps.
+    """
+    steps = [parse_geometry(step['geometry']) for step in leg['steps']]
+    # Consecutive steps share their boundary point
+    return np.concatenate(steps[:1] + [step_points[1:] for step_points in steps[1:]]).reshape(-1, 2)
+
+
+@st.cache_data # Cache the route data to avoid repeated API calls
+def get_osrm_routes_batch(routes_stops: list[list[tuple[float, float, str]]]) -> list[np.ndarray] | None:
+    """
+    Fetches several driving routes from the OSRM API in a single request.
+    The stops of all routes are sent as one waypoint list, the leg of each route is
+    recovered from the response while the legs joining two routes are dropped.
+    Returns None when the batch can not be used, callers should then fetch each route separately.
+    Raises requests.exceptions.RequestException when OSRM can not be reached, in which case
+    fetching each route separately would only wait on the same server again.
+    """
+    coordinates = ';'.join(map(format_coordinates, routes_stops))
+    # Only the first and last stop of each route delimit legs
+    waypoints = []
+    offset = 0
+    for stops in routes_stops:
+        waypoints += [offset, offset + len(stops) - 1]
+        offset += len(stops)
+    # U-turns stay allowed at the stops, otherwise the end of a route and the start of the next one
+    # would have to line up with the connecting leg, which adds detours to both routes
+    url = (
+        f"{OSRM_URL}{coordinates}?overview=false&geometries={OSRM_GEOMETRIES}&steps=true"
+        f"&alternatives=false&continue_straight=false&waypoints={';'.join(map(str, waypoints))}"
+    )
+    if len(routes_stops) < 2 or len(url) > MAX_URL_LENGTH:
+        return None
+    key = cache_key(url)
+    if key in _CACHE:
+        return _CACHE[key]
+
+    # OSRM answers errors such as too many coordinates with a JSON code, the status is not checked
+    data = _SESSION.get(url, timeout=OSRM_TIMEOUT).json()
+    if not (data and data.get('code') == 'Ok' and data.get('routes')):
+        return None
+    legs = data['routes'][0]['legs']
+    # Even legs are the routes, odd legs join the end of a route to the start of the next one
+    if len(legs) != 2 * len(routes_stops) - 1:
+        return None
+    try:
+        decoded_routes = [decode_leg(leg).astype(ROUTE_DTYPE) for leg in legs[::2]]
+    except (KeyError, ValueError): # Unexpected geometries are recovered by the per route fallback
+        return None
+    _CACHE.set(key, decoded_routes)
+    return decoded_routes
+
+
+def fetch_routes(routes_stops: dict[str, list[tuple[float, float, str]]]) -> dict[str, np.ndarray | None]:
+    """
+    Fetches the OSRM route of every stop list, in one batched request when possible
+    and otherwise with one concurrent request per route.
+    """
+    try:
+        batch = get_osrm_routes_batch(list(routes_stops.values()))
+    except requests.exceptions.RequestException as e:
+        # The server is down or too slow, every route fails right away instead of retrying one by one
+        st.error(f"Error connecting to OSRM: {e}")
+        return dict.fromkeys(routes_stops)
+    if batch is not None:
+        return dict(zip(routes_stops, batch))
+    # The calls are network bound, they all wait on the same event loop
+    return dict(zip(routes_stops, asyncio.run(fetch_osrm_routes(list(routes_stops.values())))))
+
+
+def to_locations(points: np.ndarray) -> list:
+    """
+    Converts route points to the Python floats folium expects.
+    The float32 values are widened and rounded to 6 decimals (about 10cm), otherwise each
+    coordinate would be written to the HTML with all the noise digits of the widening.
+    """
+    return points.astype(float).round(6).tolist()
+
 
 def build_bus_line(
     route_name: str,
-    route_points: list[tuple[float, float]],
+    route_points: np.ndarray,
     route_stops: list[tuple[float, float, str]]
 ) -> folium.FeatureGroup:
     bus_line = folium.FeatureGroup(name=f"Bus {route_name.capitalize()}")
     folium.Marker(
-        location=route_points[0],
+        location=to_locations(route_points[0]),
         tooltip=route_stops[0][2],
         icon=folium.Icon(color='green', icon='play', prefix='fa')
     ).add_to(bus_line)
+    # Intermediate stops are clustered by Leaflet until the map is zoomed in on them
+    stop_cluster = MarkerCluster(
+        control=False,
+        options={"disableClusteringAtZoom": 14, "showCoverageOnHover": False}
+    ).add_to(bus_line)
     for point in route_stops[1:-1]:
         folium.Marker(
             location=point[:2],
             icon=folium.Icon(color='orange', icon='info-sign', prefix='fa'),
             tooltip=point[2],
             opacity=0.4
-        ).add_to(bus_line)
-    folium.Marker(
-        location=route_points[st.session_state[route_name]], # Slightly different location
-        tooltip=f"Bus {route_name.capitalize()}",
-        icon=folium.Icon(color='blue', icon='bus', prefix='fa')
-    ).add_to(bus_line)
+        ).add_to(stop_cluster)
     # Add the PolyLine to highlight the road itinerary using OSRM data
     folium.PolyLine(
-        locations=route_points, # Use the decoded points from OSRM
+        # Only the drawn line is simplified, the bus moves along the full resolution route
+        locations=to_locations(simplify_route(route_points)), # Use the decoded points from OSRM
         color='blue',       # Color of the line
         weight=5,           # Thickness of the line
         opacity=0.5,        # Transparency of the line
@@ -74,6 +351,61 @@ def build_bus_line(
     return bus_line
 
 
+def add_bus_marker(
+    buses: folium.FeatureGroup,
+    route_name: str,
+    position: tuple[float, float]
+) -> None:
+    folium.Marker(
+        location=position,
+        tooltip=f"Bus {route_name.capitalize()}",
+        icon=folium.Icon(color='blue', icon='bus', prefix='fa')
+    ).add_to(buses)
+
+
+def read_stops(route_path: Path) -> list[tuple[float, float, str]]:
+    """
+    Reads the stops of a route CSV file as (latitude, longitude, name) tuples.
+    """
+    with open(route_path, newline='', encoding='utf-8') as route_file:
+        # Fields are separated by ", " in the route files
+        reader = csv.DictReader(route_file, skipinitialspace=True)
+        return [
+            (float(row["Latitude"]), float(row["Longitude"]), row["Stop Name"])
+            for row in reader
+        ]
+
+
+def precomputed_route_path(route_path: Path) -> Path:
+    """
+    Path of the route precomputed for a CSV file. The name carries a hash of the OSRM request
+    options and of the route dtype, so files written with other settings are never loaded.
+    """
+    settings = f"{route_url([])}|{np.dtype(ROUTE_DTYPE)}"
+    return PRECOMPUTED_PATH / f"{route_path.stem}.{hashlib.sha1(settings.encode()).hexdigest()[:12]}.npy"
+
+
+def route_fingerprint(route_path: Path) -> tuple[str, int, int]:
+    """
+    Identifies the current content of a route as the path and modification time of its CSV file
+    and the modification time of its precomputed file, 0 when there is none.
+    """
+    precomputed_path = precomputed_route_path(route_path)
+    precomputed_mtime = precomputed_path.stat().st_mtime_ns if precomputed_path.exists() else 0
+    return str(route_path), route_path.stat().st_mtime_ns, precomputed_mtime
+
+
+def load_precomputed_route(route_path: Path) -> np.ndarray | None:
+    """
+    Loads the route precomputed for a CSV file by tools/precompute_routes.py.
+    Returns None when there is none or when the CSV file changed since.
+    """
+    precomputed_path = precomputed_route_path(route_path)
+    if not precomputed_path.exists() or precomputed_path.stat().st_mtime < route_path.stat().st_mtime:
+        return None
+    return np.load(precomputed_path).astype(ROUTE_DTYPE, copy=False)
+
+
 def init_map() -> folium.Map:
     plot = folium.Map(location=SC_COORDS, zoom_start=12)
     folium.Marker(
@@ -83,32 +415,93 @@ def init_map() -> folium.Map:
     ).add_to(plot)
     return plot
 
-def build_map():
+
+@st.cache_resource # Load the routes once, they are shared by every session and rerun
+def get_routes(
+    fingerprints: tuple[tuple[str, int, int], ...]
+) -> tuple[dict[str, list[tuple[float, float, str]]], dict[str, np.ndarray | None]]:
+    """
+    Reads the stops and loads the route of every CSV file.
+    The files are given by their route_fingerprint, which is much cheaper to hash than
+    the stops, and changes whenever a CSV file is edited or a route is precomputed again.
+    The cached routes are shared and must not be modified.
+    """
+    route_paths = [Path(route_path) for route_path, *_ in fingerprints]
+    route_stops = {route_path.stem: read_stops(route_path) for route_path in route_paths}
+    osm_routes = {route_path.stem: load_precomputed_route(route_path) for route_path in route_paths}
+    # Only the routes missing from the precomputed files are fetched from OSRM
+    missing_stops = {
+        route_name: stops for route_name, stops in route_stops.items() if osm_routes[route_name] is None
+    }
+    if missing_stops:
+        osm_routes.update(fetch_routes(missing_stops))
+    return route_stops, osm_routes
+
+
+def build_base_map(fingerprints: tuple[tuple[str, int, int], ...]) -> folium.Map:
+    """
+    Builds the map with the stops and itinerary of every route, without the buses.
+    """
+    route_stops, osm_routes = get_routes(fingerprints)
     plot = init_map()
-    routes_path = Path(__file__).parent / "routes"
-    route_paths = list(routes_path.rglob("**/*.csv"))
+    for route_name, route_points in osm_routes.items():
+        if route_points is not None:
+            build_bus_line(route_name, route_points, route_stops[route_name]).add_to(plot)
+    folium.LayerControl(position="topleft", collapsed=True).add_to(plot)
+    return plot
+
+
+def get_session_map(fingerprints: tuple[tuple[str, int, int], ...]) -> folium.Map:
+    """
+    Returns the base map of the current session, built on its first run and again when a route file changes.
+    st_folium adds the bus layer to the map it renders, so the map can not be shared between sessions
+    and the bus layer of the previous run is removed before the map is reused.
+    """
+    if st.session_state.get("base_map_fingerprints") != fingerprints:
+        st.session_state["base_map_fingerprints"] = fingerprints
+        st.session_state["base_map"] = build_base_map(fingerprints)
+    plot = st.session_state["base_map"]
+    previous_buses = st.session_state.pop("bus_layer", None)
+    for name, child in list(plot._children.items()):
+        if child is previous_buses:
+            del plot._children[name]
+    return plot
+
+
+def build_map() -> tuple[folium.Map, folium.FeatureGroup]:
+    """
+    Returns the base map of the session and the layer holding the current position of the buses.
+    Only the bus layer is built on each rerun, everything else is reused.
+    """
+    # Route files all sit directly in routes/, sorted so the cache keys do not depend on listing order
+    route_paths = sorted(ROUTES_PATH.glob("*.csv"))
+    fingerprints = tuple(map(route_fingerprint, route_paths))
+    _, osm_routes = get_routes(fingerprints)
     routes = {}
     for route_path in route_paths:
-        route_frame = pd.read_csv(route_path)
-        osm_route = get_osrm_route(route_frame)
+        osm_route = osm_routes[route_path.stem]
         if osm_route is None:
             st.error(f"Failed to fetch route for {route_path.name}.")
             continue
         routes[route_path.stem] = osm_route
         if route_path.stem not in st.session_state:
             st.session_state[route_path.stem] = 0
-        bus_line = build_bus_line(route_path.stem, osm_route, route_frame.values.tolist())
-        bus_line.add_to(plot)
+    # The map keeps its element ids across reruns, so its rendered script and component key stay the same
+    plot = get_session_map(fingerprints)
+    # Only the buses move between reruns, they live in their own layer
+    buses = folium.FeatureGroup(name="Bus")
+    for route_name, route in routes.items():
+        add_bus_marker(buses, route_name, to_locations(route[st.session_state[route_name]]))
+    st.session_state["bus_layer"] = buses
     build_sidebar(routes)
-    folium.LayerControl(position="topleft", collapsed=True).add_to(plot)
-    return plot
+    return plot, buses
 
-def build_sidebar(routes: dict[str, list[tuple[float, float]]]) -> None:
+def build_sidebar(routes: dict[str, np.ndarray]) -> None:
     st.sidebar.header("Position des Bus")
     if st.sidebar.button("Rafraîchir la carte"):
         for route_name, route in routes.items():
             trip_length = random.randint(5, 15)
-            step = len(route)//trip_length
+            step = max(1, len(route)//trip_length) # Short routes must still move
             st.session_state[route_name] = (st.session_state[route_name] + step) % len(route)
         st.rerun()
     for route_name in routes:
@@ -117,11 +510,20 @@ def build_sidebar(routes: dict[str, list[tuple[float, float]]]) -> None:
             text = f"Bus {route_name.capitalize()}",
         )
 
-st.set_page_config(layout="wide")
 if __name__ == "__main__":
-    plot = build_map()
+    # First Streamlit command of the page, it is not run when the module is imported
+    st.set_page_config(layout="wide")
+    plot, buses = build_map()
     st.title("Bus Sacré Coeur")
-    st.components.v1.html(plot._repr_html_(), height=600, scrolling=False)
+    # The base map is rendered once, reruns only replace the bus layer in the browser
+    st_folium(
+        plot,
+        key="map",
+        height=600,
+        use_container_width=True,
+        feature_group_to_add=buses,
+        returned_objects=[],
+    )
     st.write(
         """
         Cette carte affiche les itinéraires des bus de Sacré Coeur.
@@ -0,0 +1,33 @@
+"""
+Fetches the OSRM route of every CSV file in `routes/` and saves it in `routes/_cache`,
+so that the app can draw the routes without calling OSRM at runtime.
+
+Usage: python tools/precompute_routes.py
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from main import PRECOMPUTED_PATH, ROUTES_PATH, get_osrm_route, precomputed_route_path, read_stops
+
+
+def main() -> int:
+    PRECOMPUTED_PATH.mkdir(parents=True, exist_ok=True)
+    failed = 0
+    for route_path in sorted(ROUTES_PATH.glob("*.csv")):
+        try:
+            route = get_osrm_route(read_stops(route_path))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Failed to fetch route for {route_path.name}: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        np.save(precomputed_route_path(route_path), route)
+        print(f"Saved {len(route)} points for {route_path.name}.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())